@@ -5,7 +5,7 @@ from __future__ import annotations
 
 Run after Authentik is deployed and healthy in the bike-weather-auth namespace.
 Creates OAuth2 providers and applications for both production and preview environments.
-Stores the API token in Azure Key Vault.
+Stores the API token in Azure Key Vault; re-runs reuse it from there.
 
 Idempotent — safe to re-run.
 
@@ -20,15 +20,24 @@ Usage:
 """
 
 import argparse
+import gzip
+import http.client
 import json
 import os
+import ssl
 import subprocess
 import sys
-import urllib.request
-import urllib.error
+import threading
+import time
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
+from types import MappingProxyType
 
 NAMESPACE = "bike-weather-auth"
+SERVER_DEPLOYMENT = "bike-weather-auth-server"
+TOKEN_MARKER = "API_TOKEN="
 VAULT_NAME = "homelab-timosur"
+VAULT_URL = f"https://{VAULT_NAME}.vault.azure.net"
 
 APPS = [
     {
@@ -53,58 +62,238 @@ APPS = [
     },
 ]
 
-HEADERS = {
-    "Content-Type": "application/json",
-    "Accept": "application/json",
+# Objects looked up by setup_recovery_flow(): kind -> (list endpoint, key field)
+RECOVERY_LISTINGS = {
+    "flows": ("/api/v3/flows/instances/", "slug"),
+    "identification": ("/api/v3/stages/identification/", "name"),
+    "email": ("/api/v3/stages/email/", "name"),
+    "password": ("/api/v3/stages/prompt/stages/", "name"),
+    "user_write": ("/api/v3/stages/user_write/", "name"),
 }
 
+# Password prompt fields shared by every recovery flow, by field key
+PASSWORD_PROMPTS = {
+    "password": {
+        "name": "recovery-password-field",
+        "label": "New Password",
+        "placeholder": "New Password",
+        "order": 0,
+    },
+    "password_repeat": {
+        "name": "recovery-password-repeat-field",
+        "label": "Repeat Password",
+        "placeholder": "Repeat Password",
+        "order": 1,
+    },
+}
 
-def api(base: str, method: str, path: str, data=None):
-    body = json.dumps(data).encode() if data else None
-    req = urllib.request.Request(
-        f"{base}{path}", data=body, headers=HEADERS, method=method
-    )
-    try:
-        with urllib.request.urlopen(req) as resp:
+# OAuth2 provider settings shared by every app.
+PROVIDER_DEFAULTS = {
+    "client_type": "public",
+    "access_code_validity": "minutes=10",
+    "access_token_validity": "hours=1",
+    "refresh_token_validity": "days=30",
+    "sub_mode": "hashed_user_id",
+    "include_claims_in_id_token": True,
+}
+
+HEADERS = MappingProxyType(
+    {
+        "Content-Type": "application/json",
+        "Accept": "application/json",
+        "Accept-Encoding": "gzip",
+    }
+)
+
+# request() retries transient failures up to MAX_ATTEMPTS times
+MAX_ATTEMPTS = 4
+RETRY_STATUSES = frozenset({429, 502, 503, 504})
+IDEMPOTENT_METHODS = frozenset({"GET", "HEAD", "PUT", "PATCH", "DELETE"})
+
+
+# Per-app steps and independent lookups run concurrently on this pool. Threads
+# are kept alive between steps so each keeps its own keep-alive connection.
+POOL = ThreadPoolExecutor(max_workers=max(len(APPS), 3))
+
+_local = threading.local()
+_conns: list[http.client.HTTPConnection] = []
+_conns_lock = threading.Lock()
+
+
+def log(msg: str = ""):
+    """Print, or buffer the line while running inside for_each_app()."""
+    lines = getattr(_local, "log", None)
+    if lines is None:
+        print(msg)
+    else:
+        lines.append(msg)
+
+
+def for_each_app(fn) -> list:
+    """Run fn(app_config) for all APPS concurrently. Returns results in order.
+
+    Output logged by each app is printed as one block after it finishes, so
+    lines from concurrent apps don't interleave.
+    """
+    logs = [[] for _ in APPS]
+
+    def task(app_config: dict, lines: list):
+        _local.log = lines
+        try:
+            return fn(app_config)
+        finally:
+            _local.log = None
+
+    futures = [POOL.submit(task, a, lines) for a, lines in zip(APPS, logs)]
+    results = []
+    for future, lines in zip(futures, logs):
+        exc = future.exception()
+        for line in lines:
+            print(line)
+        if exc:
+            raise exc
+        results.append(future.result())
+    return results
+
+
+def _connection(base: str) -> http.client.HTTPConnection:
+    """Return this thread's keep-alive connection to base's host, opening it once.
+
+    http.client connections are not thread-safe, so each thread gets its own.
+    """
+    url = urllib.parse.urlsplit(base)
+    conns = getattr(_local, "conns", None)
+    if conns is None:
+        conns = _local.conns = {}
+    conn = conns.get(url.netloc)
+    if conn is None:
+        if url.scheme == "https":
+            conn = http.client.HTTPSConnection(url.netloc, timeout=30)
+        else:
+            conn = http.client.HTTPConnection(url.netloc, timeout=30)
+        conns[url.netloc] = conn
+        with _conns_lock:
+            _conns.append(conn)
+    return conn
+
+
+_api_headers = HEADERS
+
+
+def set_api_token(token: str):
+    """Authenticate all following Authentik API requests with token.
+
+    The headers are swapped for a new read-only mapping rather than mutated,
+    so worker threads never see a half-updated dict.
+    """
+    global _api_headers
+    _api_headers = MappingProxyType({**HEADERS, "Authorization": f"Bearer {token}"})
+
+
+def request(
+    base: str,
+    method: str,
+    path: str,
+    body: bytes | None = None,
+    headers: dict | None = None,
+):
+    """Send a request over this thread's connection. Returns (status, content).
+
+    Reusing one connection per host saves a TCP+TLS handshake per call.
+    Sends the Authentik API headers unless headers is given.
+
+    Network errors (dropped connections, timeouts, DNS or TLS failures) close
+    the connection and are retried on a fresh one, with exponential backoff up
+    to MAX_ATTEMPTS; certificate verification failures are not retried.
+    Transient statuses (RETRY_STATUSES) are retried the same way. Both only
+    apply to idempotent methods once the request has been sent, so a POST is
+    never repeated after the server may have handled it. The exception is a
+    reused keep-alive connection the server closed without answering, which
+    it does for idle connections before reading the request.
+    """
+    url = f"{urllib.parse.urlsplit(base).path}{path}"
+    conn = _connection(base)
+    for attempt in range(MAX_ATTEMPTS):
+        if attempt:
+            time.sleep(0.25 * 2 ** (attempt - 1))
+        reused, sent = conn.sock is not None, False
+        try:
+            conn.request(method, url, body=body, headers=headers or _api_headers)
+            sent = True
+            resp = conn.getresponse()
             content = resp.read()
-            if not content:
-                return {}
-            return json.loads(content)
-    except urllib.error.HTTPError as e:
-        err = e.read().decode()
-        print(f"  ERROR {e.code}: {err[:300]}")
+        except ssl.SSLCertVerificationError:
+            conn.close()
+            raise
+        except (http.client.HTTPException, OSError) as e:
+            conn.close()
+            retry = (
+                not sent
+                or method in IDEMPOTENT_METHODS
+                or (reused and isinstance(e, http.client.RemoteDisconnected))
+            )
+            if not retry or attempt == MAX_ATTEMPTS - 1:
+                raise
+            continue
+        if resp.getheader("Content-Encoding") == "gzip":
+            content = gzip.decompress(content)
+        if (
+            resp.status in RETRY_STATUSES
+            and method in IDEMPOTENT_METHODS
+            and attempt < MAX_ATTEMPTS - 1
+        ):
+            continue
+        return resp.status, content
+
+
+def _decode(status: int, content: bytes):
+    if status >= 400:
+        err = content.decode()
+        log(f"  ERROR {status}: {err[:300]}")
         try:
             return json.loads(err)
         except json.JSONDecodeError:
             return {}
+    if not content:
+        return {}
+    return json.loads(content)
 
 
-def ensure_api_token() -> str:
-    """Create an API token via kubectl exec into the Authentik server pod."""
-    # Find the server pod
-    result = subprocess.run(
-        [
-            "kubectl",
-            "get",
-            "pods",
-            "-n",
-            NAMESPACE,
-            "-l",
-            "app=bike-weather-auth-server",
-            "-o",
-            "jsonpath={.items[0].metadata.name}",
-        ],
-        capture_output=True,
-        text=True,
-    )
-    pod_name = result.stdout.strip()
-    if not pod_name:
-        print(f"ERROR: No Authentik server pod found in namespace {NAMESPACE}")
-        print(f"  stdout: {result.stdout}")
-        print(f"  stderr: {result.stderr}")
-        sys.exit(1)
+def api(base: str, method: str, path: str, data=None):
+    body = json.dumps(data).encode() if data else None
+    return _decode(*request(base, method, path, body))
+
+
+def paged(base: str, path: str) -> list:
+    """GET every page of a list endpoint and return all results."""
+    sep = "&" if "?" in path else "?"
+    results = []
+    page = 1
+    while page:
+        data = api(base, "GET", f"{path}{sep}page={page}&page_size=100")
+        results += data.get("results", [])
+        page = data.get("pagination", {}).get("next")
+    return results
+
+
+def create(base: str, path: str, query: dict, data: dict):
+    """POST data to path. Returns (object, created).
+
+    If the POST is rejected because the object already exists (HTTP 400 on a
+    unique field), it is looked up by the exact filters in query instead of
+    failing. On failure the object is the error response.
+    """
+    status, content = request(base, "POST", path, json.dumps(data).encode())
+    if status == 400:
+        existing = api(base, "GET", f"{path}?{urllib.parse.urlencode(query)}")
+        if existing.get("results"):
+            return existing["results"][0], False
+    return _decode(status, content), status < 400
 
-    print(f"   Using pod: {pod_name}")
+
+def ensure_api_token() -> str:
+    """Create an API token via kubectl exec into the Authentik server deployment."""
+    print(f"   Using deployment: {SERVER_DEPLOYMENT}")
 
     code = (
         "import os, django; "
@@ -115,7 +304,7 @@ def ensure_api_token() -> str:
         "t,_=Token.objects.get_or_create("
         "identifier='bike-weather-homelab-setup',"
         "defaults={'user':u,'intent':TokenIntents.INTENT_API,'expiring':False}); "
-        "print(t.key)"
+        f"print('{TOKEN_MARKER}' + t.key)"
     )
     result = subprocess.run(
         [
@@ -123,17 +312,26 @@ def ensure_api_token() -> str:
             "exec",
             "-n",
             NAMESPACE,
-            pod_name,
+            f"deployment/{SERVER_DEPLOYMENT}",
             "--",
             "python",
             "-c",
             code,
         ],
+        stdin=subprocess.DEVNULL,
         capture_output=True,
         text=True,
     )
-    token = result.stdout.strip().split("\n")[-1]
-    if not token or len(token) < 10:
+    # Django may log to stdout too, so pick out the marked line
+    token = next(
+        (
+            line[len(TOKEN_MARKER) :].strip()
+            for line in result.stdout.splitlines()
+            if line.startswith(TOKEN_MARKER)
+        ),
+        None,
+    )
+    if not token:
         print(f"Failed to get API token.")
         print(f"  stdout: {result.stdout}")
         print(f"  stderr: {result.stderr}")
@@ -141,49 +339,105 @@ def ensure_api_token() -> str:
     return token
 
 
-def set_keyvault_secret(key: str, value: str):
-    """Store a secret in Azure Key Vault."""
+def get_keyvault_token() -> str | None:
+    """Get a Key Vault access token from the logged-in az CLI."""
     result = subprocess.run(
         [
             "az",
-            "keyvault",
-            "secret",
-            "set",
-            "--vault-name",
-            VAULT_NAME,
-            "--name",
-            key,
-            "--value",
-            value,
+            "account",
+            "get-access-token",
+            "--resource",
+            "https://vault.azure.net",
+            "--query",
+            "accessToken",
             "--output",
-            "none",
+            "tsv",
         ],
+        stdin=subprocess.DEVNULL,
         capture_output=True,
         text=True,
     )
     if result.returncode != 0:
-        print(f"  WARNING: Failed to set Key Vault secret {key}: {result.stderr}")
+        print(f"   WARNING: Failed to get Key Vault access token: {result.stderr}")
+        return None
+    return result.stdout.strip()
+
+
+def get_stored_api_token(base: str, vault_token: str) -> str | None:
+    """Return the API token a previous run stored in Key Vault, if still valid.
+
+    Lets re-runs skip the kubectl exec, which has to boot Django in the pod.
+    """
+    key = APPS[0]["keyvault_token_key"]
+    try:
+        status, content = request(
+            VAULT_URL,
+            "GET",
+            f"/secrets/{key}?api-version=7.4",
+            headers={"Authorization": f"Bearer {vault_token}"},
+        )
+        if status >= 400:
+            return None
+        token = json.loads(content).get("value")
+        if not token:
+            return None
+        status, _ = request(
+            base,
+            "GET",
+            "/api/v3/core/users/me/",
+            headers={**HEADERS, "Authorization": f"Bearer {token}"},
+        )
+    except (OSError, http.client.HTTPException) as e:
+        print(f"   WARNING: Failed to read API token from Key Vault: {e}")
+        return None
+    return token if status < 400 else None
+
+
+def set_keyvault_secret(vault_token: str, key: str, value: str):
+    """Store a secret in Azure Key Vault via its REST API."""
+    try:
+        status, content = request(
+            VAULT_URL,
+            "PUT",
+            f"/secrets/{key}?api-version=7.4",
+            json.dumps({"value": value}).encode(),
+            {
+                "Authorization": f"Bearer {vault_token}",
+                "Content-Type": "application/json",
+            },
+        )
+    except (OSError, http.client.HTTPException) as e:
+        log(f"  WARNING: Failed to set Key Vault secret {key}: {e}")
+        return False
+    if status >= 400:
+        log(f"  WARNING: Failed to set Key Vault secret {key}: {content.decode()}")
         return False
     return True
 
 
-def setup_recovery_flow(base: str, app_config: dict):
+def setup_recovery_flow(
+    base: str, app_config: dict, existing: dict, prompt_pks: dict
+):
     """Create or configure a recovery flow for the given app.
 
     Each app gets its own recovery flow with a dedicated email stage
     that uses the app-specific email template (mounted via ConfigMap).
+    existing maps each object kind in RECOVERY_LISTINGS to its existing
+    objects, fetched once for all apps, and prompt_pks maps the
+    PASSWORD_PROMPTS field keys to pks.
     """
     flow_slug = app_config["recovery_flow_slug"]
     email_template = app_config["email_template"]
     app_name = app_config["name"]
 
-    print(f"\n   Setting up recovery flow: {flow_slug}")
+    log(f"\n   Setting up recovery flow: {flow_slug}")
 
     # 1. Create or find the recovery flow
-    flows = api(base, "GET", f"/api/v3/flows/instances/?slug={flow_slug}")
-    if flows.get("results"):
-        flow_pk = flows["results"][0]["pk"]
-        print(f"     Flow exists (pk={flow_pk})")
+    flow = existing["flows"].get(flow_slug)
+    flow_created = False
+    if flow:
+        flow_pk = flow["pk"]
+        log(f"     Flow exists (pk={flow_pk})")
     else:
         flow = api(
             base,
@@ -201,22 +455,25 @@ def setup_recovery_flow(base: str, app_config: dict):
         )
         flow_pk = flow.get("pk")
         if not flow_pk:
-            print(f"     FAILED to create recovery flow: {flow}")
+            log(f"     FAILED to create recovery flow: {flow}")
             return
-        print(f"     Flow created (pk={flow_pk})")
-
-    # 2. Get existing bindings
-    existing_bindings = api(
-        base, "GET", f"/api/v3/flows/bindings/?target={flow_pk}&ordering=order"
-    )
-    bound_stages = {b["stage"]: b for b in existing_bindings.get("results", [])}
+        log(f"     Flow created (pk={flow_pk})")
+        flow_created = True
+
+    # 2. Get existing bindings (a flow created just now has none)
+    bound_stages = {}
+    if not flow_created:
+        existing_bindings = api(
+            base, "GET", f"/api/v3/flows/bindings/?target={flow_pk}&ordering=order"
+        )
+        bound_stages = {b["stage"]: b for b in existing_bindings.get("results", [])}
 
     # 3. Identification stage
     ident_name = f"{flow_slug}-identification"
-    existing = api(base, "GET", f"/api/v3/stages/identification/?search={ident_name}")
-    if existing.get("results"):
-        ident_pk = existing["results"][0]["pk"]
-        print(f"     Identification stage exists (pk={ident_pk})")
+    stage = existing["identification"].get(ident_name)
+    if stage:
+        ident_pk = stage["pk"]
+        log(f"     Identification stage exists (pk={ident_pk})")
     else:
         stage = api(
             base,
@@ -232,16 +489,21 @@ def setup_recovery_flow(base: str, app_config: dict):
         )
         ident_pk = stage.get("pk")
         if ident_pk:
-            print(f"     Identification stage created (pk={ident_pk})")
+            log(f"     Identification stage created (pk={ident_pk})")
         else:
-            print(f"     FAILED: {stage}")
+            log(f"     FAILED: {stage}")
 
     # 4. Email stage
     email_name = f"{flow_slug}-email"
-    existing = api(base, "GET", f"/api/v3/stages/email/?search={email_name}")
-    if existing.get("results"):
-        email_pk = existing["results"][0]["pk"]
-        print(f"     Email stage exists (pk={email_pk})")
+    email_settings = {
+        "template": email_template,
+        "subject": "Fahrrad Wetter \u2014 Password Reset",
+        "activate_user_on_success": True,
+    }
+    stage = existing["email"].get(email_name)
+    if stage:
+        email_pk = stage["pk"]
+        log(f"     Email stage exists (pk={email_pk})")
     else:
         stage = api(
             base,
@@ -249,84 +511,31 @@ def setup_recovery_flow(base: str, app_config: dict):
             "/api/v3/stages/email/",
             {
                 "name": email_name,
-                "template": email_template,
-                "subject": "Fahrrad Wetter \u2014 Password Reset",
-                "activate_user_on_success": True,
+                **email_settings,
                 "use_global_settings": True,
                 "token_expiry": "minutes=30",
             },
         )
         email_pk = stage.get("pk")
         if email_pk:
-            print(f"     Email stage created (pk={email_pk})")
+            log(f"     Email stage created (pk={email_pk})")
         else:
-            print(f"     FAILED: {stage}")
+            log(f"     FAILED: {stage}")
 
-    # Always patch email stage to ensure template is correct
+    # Patch the email stage if its template settings have drifted
     if email_pk:
-        api(
-            base,
-            "PATCH",
-            f"/api/v3/stages/email/{email_pk}/",
-            {
-                "template": email_template,
-                "subject": "Fahrrad Wetter \u2014 Password Reset",
-                "activate_user_on_success": True,
-            },
-        )
-        print(f"     \u2713 Email template: {email_template}")
+        if any(stage.get(k) != v for k, v in email_settings.items()):
+            api(base, "PATCH", f"/api/v3/stages/email/{email_pk}/", email_settings)
+        log(f"     \u2713 Email template: {email_template}")
 
     # 5. Password prompt stage
     pw_name = f"{flow_slug}-password"
-    existing = api(base, "GET", f"/api/v3/stages/prompt/stages/?search={pw_name}")
-    if existing.get("results"):
-        pw_pk = existing["results"][0]["pk"]
-        print(f"     Password stage exists (pk={pw_pk})")
+    stage = existing["password"].get(pw_name)
+    if stage:
+        pw_pk = stage["pk"]
+        log(f"     Password stage exists (pk={pw_pk})")
     else:
-        # Find or create prompt fields
-        prompts = api(base, "GET", "/api/v3/stages/prompt/prompts/")
-        pw_prompt_pk = pw_repeat_pk = None
-        for p in prompts.get("results", []):
-            if p.get("field_key") == "password":
-                pw_prompt_pk = p["pk"]
-            elif p.get("field_key") == "password_repeat":
-                pw_repeat_pk = p["pk"]
-
-        if not pw_prompt_pk:
-            r = api(
-                base,
-                "POST",
-                "/api/v3/stages/prompt/prompts/",
-                {
-                    "name": f"{flow_slug}-password-field",
-                    "field_key": "password",
-                    "label": "New Password",
-                    "type": "password",
-                    "required": True,
-                    "placeholder": "New Password",
-                    "order": 0,
-                },
-            )
-            pw_prompt_pk = r.get("pk")
-
-        if not pw_repeat_pk:
-            r = api(
-                base,
-                "POST",
-                "/api/v3/stages/prompt/prompts/",
-                {
-                    "name": f"{flow_slug}-password-repeat-field",
-                    "field_key": "password_repeat",
-                    "label": "Repeat Password",
-                    "type": "password",
-                    "required": True,
-                    "placeholder": "Repeat Password",
-                    "order": 1,
-                },
-            )
-            pw_repeat_pk = r.get("pk")
-
-        fields = [pk for pk in [pw_prompt_pk, pw_repeat_pk] if pk]
+        fields = [prompt_pks[k] for k in PASSWORD_PROMPTS if k in prompt_pks]
         stage = api(
             base,
             "POST",
@@ -335,16 +544,16 @@ def setup_recovery_flow(base: str, app_config: dict):
         )
         pw_pk = stage.get("pk")
         if pw_pk:
-            print(f"     Password stage created (pk={pw_pk})")
+            log(f"     Password stage created (pk={pw_pk})")
         else:
-            print(f"     FAILED: {stage}")
+            log(f"     FAILED: {stage}")
 
     # 6. User-write stage
     write_name = f"{flow_slug}-user-write"
-    existing = api(base, "GET", f"/api/v3/stages/user_write/?search={write_name}")
-    if existing.get("results"):
-        write_pk = existing["results"][0]["pk"]
-        print(f"     User-write stage exists (pk={write_pk})")
+    stage = existing["user_write"].get(write_name)
+    if stage:
+        write_pk = stage["pk"]
+        log(f"     User-write stage exists (pk={write_pk})")
     else:
         stage = api(
             base,
@@ -354,9 +563,9 @@ def setup_recovery_flow(base: str, app_config: dict):
         )
         write_pk = stage.get("pk")
         if write_pk:
-            print(f"     User-write stage created (pk={write_pk})")
+            log(f"     User-write stage created (pk={write_pk})")
         else:
-            print(f"     FAILED: {stage}")
+            log(f"     FAILED: {stage}")
 
     # 7. Bind stages in order
     stage_order = [
@@ -377,41 +586,138 @@ def setup_recovery_flow(base: str, app_config: dict):
             {"target": flow_pk, "stage": stage_pk, "order": order},
         )
         if binding.get("pk"):
-            print(f"     Bound stage (order={order})")
+            log(f"     Bound stage (order={order})")
+        else:
+            log(f"     FAILED to bind at order {order}: {binding}")
+
+    log(f"     \u2713 Recovery flow {flow_slug} ready")
+
+
+def get_password_prompts(base: str) -> dict:
+    """Find or create the PASSWORD_PROMPTS fields. Returns field key -> pk."""
+    prompt_pks = {
+        p["field_key"]: p["pk"]
+        for p in paged(base, "/api/v3/stages/prompt/prompts/")
+        if p["field_key"] in PASSWORD_PROMPTS
+    }
+    for field_key, prompt in PASSWORD_PROMPTS.items():
+        if field_key in prompt_pks:
+            continue
+        r = api(
+            base,
+            "POST",
+            "/api/v3/stages/prompt/prompts/",
+            {
+                **prompt,
+                "field_key": field_key,
+                "type": "password",
+                "required": True,
+            },
+        )
+        if r.get("pk"):
+            prompt_pks[field_key] = r["pk"]
+            print(f"   Prompt field created: {prompt['name']}")
         else:
-            print(f"     FAILED to bind at order {order}: {binding}")
+            print(f"   FAILED to create prompt field {field_key}: {r}")
+    return prompt_pks
 
-    print(f"     \u2713 Recovery flow {flow_slug} ready")
+
+def get_provider_base(base: str) -> dict:
+    """Look up the signing certificate, flows and scope mappings (steps 2-4).
+
+    The three lookups are independent, so they are sent concurrently and
+    their results reported in step order. Returns the provider fields shared
+    by all apps.
+    """
+    scope_names = ("openid", "profile", "email")
+    # Fetch only the built-in mappings for these scopes, in one request.
+    scope_query = urllib.parse.urlencode(
+        [("managed", f"goauthentik.io/providers/oauth2/scope-{n}") for n in scope_names]
+    )
+    certs_future = POOL.submit(
+        api,
+        base,
+        "GET",
+        "/api/v3/crypto/certificatekeypairs/"
+        "?name=authentik+Self-signed+Certificate&page_size=1",
+    )
+    # Narrow server-side to the default provider flows (a handful of rows)
+    # instead of paging through every flow; exact slugs are matched below.
+    flows_future = POOL.submit(
+        api, base, "GET", "/api/v3/flows/instances/?search=default-provider-"
+    )
+    scopes_future = POOL.submit(
+        api, base, "GET", f"/api/v3/propertymappings/provider/scope/?{scope_query}"
+    )
+
+    # 2. Get signing certificate
+    print("\n2. Getting signing certificate...")
+    certs = certs_future.result()
+    if not certs.get("results"):
+        print("   ERROR: No self-signed certificate found!")
+        sys.exit(1)
+    cert_pk = certs["results"][0]["pk"]
+    print(f"   Certificate: {cert_pk}")
+
+    # 3. Get flows
+    print("\n3. Getting flows...")
+    flows = flows_future.result()
+    auth_flow = invalidation_flow = None
+    for f in flows.get("results", []):
+        if f["slug"] == "default-provider-authorization-implicit-consent":
+            auth_flow = f["pk"]
+        if f["slug"] == "default-provider-invalidation-flow":
+            invalidation_flow = f["pk"]
+    if not auth_flow or not invalidation_flow:
+        print("   ERROR: Required flows not found!")
+        sys.exit(1)
+    print(f"   Authorization flow: {auth_flow}")
+    print(f"   Invalidation flow:  {invalidation_flow}")
+
+    # 4. Get scope mappings
+    print("\n4. Getting scope mappings...")
+    scopes = scopes_future.result()
+    scope_map = {s["scope_name"]: s["pk"] for s in scopes.get("results", [])}
+    mappings = [scope_map[n] for n in scope_names if n in scope_map]
+    print(f"   Mapped scopes: openid, profile, email")
+
+    return {
+        **PROVIDER_DEFAULTS,
+        "authorization_flow": auth_flow,
+        "invalidation_flow": invalidation_flow,
+        "signing_key": cert_pk,
+        "property_mappings": mappings,
+    }
 
 
 def provision_app(
     base: str,
     app_config: dict,
-    auth_flow: str,
-    invalidation_flow: str,
-    cert_pk: str,
-    mappings: list,
+    provider_base: dict | None,
+    providers: dict,
+    applications: dict,
 ) -> int | None:
-    """Create or find an OAuth2 provider + application. Returns provider pk."""
+    """Create or find an OAuth2 provider + application. Returns provider pk.
+
+    provider_base holds the provider fields shared by all apps (None when
+    every provider already exists); only the per-app fields are added here.
+    providers (by client_id) and applications (by slug) are the existing
+    objects, fetched once for all apps.
+    """
     slug = app_config["slug"]
     client_id = app_config["client_id"]
 
     # Create or find OAuth2 provider
-    print(f"\n   Provisioning OAuth2 provider: {slug}...")
-    existing = api(base, "GET", f"/api/v3/providers/oauth2/?search={slug}")
-    if existing.get("results"):
-        provider_pk = existing["results"][0]["pk"]
-        print(f"   Provider already exists (pk={provider_pk})")
-    else:
-        provider = api(
+    log(f"\n   Provisioning OAuth2 provider: {slug}...")
+    provider, created = providers.get(client_id), False
+    if provider is None:
+        provider, created = create(
             base,
-            "POST",
             "/api/v3/providers/oauth2/",
+            {"client_id": client_id},
             {
+                **provider_base,
                 "name": app_config["name"],
-                "authorization_flow": auth_flow,
-                "invalidation_flow": invalidation_flow,
-                "client_type": "public",
                 "client_id": client_id,
                 "redirect_uris": [
                     {
@@ -419,31 +725,25 @@ def provision_app(
                         "url": app_config["redirect_uri"],
                     },
                 ],
-                "signing_key": cert_pk,
-                "access_code_validity": "minutes=10",
-                "access_token_validity": "hours=1",
-                "refresh_token_validity": "days=30",
-                "sub_mode": "hashed_user_id",
-                "include_claims_in_id_token": True,
-                "property_mappings": mappings,
             },
         )
-        provider_pk = provider.get("pk")
-        if not provider_pk:
-            print(f"   FAILED to create provider for {slug}!")
-            return None
-        print(f"   Provider created (pk={provider_pk})")
+    provider_pk = provider.get("pk")
+    if not provider_pk:
+        log(f"   FAILED to create provider for {slug}!")
+        return None
+    if created:
+        log(f"   Provider created (pk={provider_pk})")
+    else:
+        log(f"   Provider already exists (pk={provider_pk})")
 
     # Create or find application
-    print(f"   Provisioning application: {slug}...")
-    existing_app = api(base, "GET", f"/api/v3/core/applications/?slug={slug}")
-    if existing_app.get("results"):
-        print(f"   Application already exists")
-    else:
-        app_result = api(
+    log(f"   Provisioning application: {slug}...")
+    app_result, created = applications.get(slug), False
+    if app_result is None:
+        app_result, created = create(
             base,
-            "POST",
             "/api/v3/core/applications/",
+            {"slug": slug},
             {
                 "name": app_config["name"],
                 "slug": slug,
@@ -452,16 +752,42 @@ def provision_app(
                 "meta_launch_url": app_config["launch_url"],
             },
         )
-        if app_result.get("slug"):
-            print(f"   Application created: {app_result['slug']}")
-        else:
-            print(f"   FAILED to create application for {slug}!")
-            return None
+    if not app_result.get("slug"):
+        log(f"   FAILED to create application for {slug}!")
+        return None
+    if created:
+        log(f"   Application created: {app_result['slug']}")
+    else:
+        log(f"   Application already exists")
 
     return provider_pk
 
 
+def verify_discovery(base: str, app_config: dict):
+    """Check that the app's OIDC discovery document is served.
+
+    Only the status matters, so a HEAD avoids downloading the document.
+    """
+    slug = app_config["slug"]
+    status, _ = request(
+        base, "HEAD", f"/application/o/{slug}/.well-known/openid-configuration"
+    )
+    if status >= 400:
+        log(f"   {slug}: FAILED ({status})")
+        return
+    log(f"   {slug}: OK")
+
+
 def main():
+    try:
+        run()
+    finally:
+        POOL.shutdown()
+        for conn in _conns:
+            conn.close()
+
+
+def run():
     parser = argparse.ArgumentParser(
         description="Bootstrap Authentik for bike-weather homelab"
     )
@@ -473,7 +799,7 @@ def main():
     parser.add_argument(
         "--skip-keyvault",
         action="store_true",
-        help="Skip writing API token to Azure Key Vault",
+        help="Skip reading and writing the API token in Azure Key Vault",
     )
     args = parser.parse_args()
     base = args.base_url.rstrip("/")
@@ -483,83 +809,89 @@ def main():
     print(f"   K8s namespace: {NAMESPACE}")
     print(f"   Key Vault:     {VAULT_NAME}")
 
-    # 1. Obtain API token via kubectl exec
-    print("\n1. Obtaining API token via kubectl exec...")
-    token = ensure_api_token()
-    HEADERS["Authorization"] = f"Bearer {token}"
+    # 1. Reuse the API token from Key Vault, or create it via kubectl exec
+    print("\n1. Obtaining API token...")
+    vault_token = None if args.skip_keyvault else get_keyvault_token()
+    token = get_stored_api_token(base, vault_token) if vault_token else None
+    if token:
+        print("   Reusing token from Key Vault")
+    else:
+        print("   Creating token via kubectl exec...")
+        token = ensure_api_token()
+    set_api_token(token)
     print(f"   Token obtained (***{token[-6:]})")
 
-    # 2. Get signing certificate
-    print("\n2. Getting signing certificate...")
-    certs = api(
-        base,
-        "GET",
-        "/api/v3/crypto/certificatekeypairs/?name=authentik+Self-signed+Certificate",
+    # Existing providers (by client_id) and applications (by slug)
+    applications_future = POOL.submit(
+        paged, base, "/api/v3/core/applications/?superuser_full_list=true"
     )
-    if not certs.get("results"):
-        print("   ERROR: No self-signed certificate found!")
-        sys.exit(1)
-    cert_pk = certs["results"][0]["pk"]
-    print(f"   Certificate: {cert_pk}")
-
-    # 3. Get flows
-    print("\n3. Getting flows...")
-    flows = api(base, "GET", "/api/v3/flows/instances/")
-    auth_flow = invalidation_flow = None
-    for f in flows.get("results", []):
-        if f["slug"] == "default-provider-authorization-implicit-consent":
-            auth_flow = f["pk"]
-        if f["slug"] == "default-provider-invalidation-flow":
-            invalidation_flow = f["pk"]
-    if not auth_flow or not invalidation_flow:
-        print("   ERROR: Required flows not found!")
-        sys.exit(1)
-    print(f"   Authorization flow: {auth_flow}")
-    print(f"   Invalidation flow:  {invalidation_flow}")
-
-    # 4. Get scope mappings
-    print("\n4. Getting scope mappings...")
-    scopes = api(base, "GET", "/api/v3/propertymappings/provider/scope/")
-    scope_map = {s["scope_name"]: s["pk"] for s in scopes.get("results", [])}
-    mappings = [scope_map[n] for n in ("openid", "profile", "email") if n in scope_map]
-    print(f"   Mapped scopes: openid, profile, email")
+    providers = {
+        p["client_id"]: p for p in paged(base, "/api/v3/providers/oauth2/")
+    }
+    applications = {a["slug"]: a for a in applications_future.result()}
+
+    # 2-4. Certificate, flows and scopes are only needed to create providers
+    if all(app_config["client_id"] in providers for app_config in APPS):
+        print("\n2-4. All providers exist, skipping certificate/flow/scope lookups")
+        provider_base = None
+    else:
+        provider_base = get_provider_base(base)
 
     # 5. Provision each application
     print("\n5. Provisioning applications...")
-    for app_config in APPS:
-        provider_pk = provision_app(
-            base, app_config, auth_flow, invalidation_flow, cert_pk, mappings
+    provider_pks = for_each_app(
+        lambda app_config: provision_app(
+            base, app_config, provider_base, providers, applications
         )
+    )
+    for app_config, provider_pk in zip(APPS, provider_pks):
         if provider_pk is None:
             print(f"\n   WARNING: Skipping {app_config['slug']} due to errors")
 
     # 6. Setup recovery flows for each app
     print("\n6. Setting up recovery flows...")
-    for app_config in APPS:
-        setup_recovery_flow(base, app_config)
+    # Existing recovery flows and stages, by kind in RECOVERY_LISTINGS
+    listings = {
+        kind: POOL.submit(paged, base, path)
+        for kind, (path, _) in RECOVERY_LISTINGS.items()
+    }
+    existing = {
+        kind: {o[RECOVERY_LISTINGS[kind][1]]: o for o in future.result()}
+        for kind, future in listings.items()
+    }
+    # Prompt fields are only needed to create a missing password stage. Missing
+    # ones are created here, before the apps run concurrently, so all flows
+    # share one pair.
+    prompt_pks = {}
+    if any(
+        f"{app_config['recovery_flow_slug']}-password" not in existing["password"]
+        for app_config in APPS
+    ):
+        prompt_pks = get_password_prompts(base)
+    for_each_app(
+        lambda app_config: setup_recovery_flow(
+            base, app_config, existing, prompt_pks
+        )
+    )
 
     # 7. Verify OIDC discovery endpoints
     print("\n7. Verifying OIDC discovery endpoints...")
-    for app_config in APPS:
-        slug = app_config["slug"]
-        try:
-            req = urllib.request.Request(
-                f"{base}/application/o/{slug}/.well-known/openid-configuration"
-            )
-            with urllib.request.urlopen(req) as resp:
-                config = json.loads(resp.read())
-                print(f"   {slug}:")
-                print(f"     Issuer: {config.get('issuer')}")
-                print(f"     OK")
-        except urllib.error.HTTPError as e:
-            print(f"   {slug}: FAILED ({e.code})")
+    for_each_app(lambda app_config: verify_discovery(base, app_config))
 
     # 8. Store API token in Azure Key Vault
     if not args.skip_keyvault:
         print("\n8. Storing API token in Azure Key Vault...")
-        for app_config in APPS:
+        if vault_token:
+            stored = for_each_app(
+                lambda app_config: set_keyvault_secret(
+                    vault_token, app_config["keyvault_token_key"], token
+                )
+            )
+        else:
+            stored = [False] * len(APPS)
+        for app_config, ok in zip(APPS, stored):
             key = app_config["keyvault_token_key"]
-            if set_keyvault_secret(key, token):
+            if ok:
                 print(f"   SET  {key}")
             else:
                 print(f"   FAIL {key}")